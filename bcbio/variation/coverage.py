@@ -3,15 +3,36 @@
 Provides estimates of coverage intervals based on callable regions
 """
 import collections
+import concurrent.futures
+import contextlib
+import filecmp
+import hashlib
 import itertools
 import os
+import shlex
 import shutil
+import subprocess
+import typing
 import yaml
 import pybedtools
 import numpy as np
+import pandas as pd
 import pysam
 import toolz as tz
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pgzip
+except ImportError:
+    pgzip = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
 from bcbio import bam, utils
 from bcbio.bam import ref, readstats
 from bcbio.distributed.transaction import file_transaction
@@ -19,11 +40,17 @@ from bcbio.log import logger
 from bcbio.pipeline import datadict as dd
 from bcbio.provenance import do
 from bcbio.pipeline import shared
+from bcbio.pipeline import tools
 from bcbio.variation import bedutils
 
 GENOME_COV_THRESH = 0.40  # percent of genome covered for whole genome analysis
 OFFTARGET_THRESH = 0.01  # percent of offtarget reads required to be capture (not amplification) based
 DEPTH_THRESHOLDS = [1,5] + sorted([k*10**exp10 for k in [1,2,5] for exp10 in range(1,6)])  # 10,20,50,100...
+SMALL_BED_SIZE = 1 << 20  # BED files smaller than this (bytes) are summarized in Python instead of bedtools
+MOSDEPTH_SHARD_CORES = 4  # mosdepth threads only speed up BAM decompression, saturating around 4
+MOSDEPTH_MAX_SHARDS = 256  # run unsharded on BEDs spanning more chromosomes, like fragmented references
+
+_TOTAL_SIZE_CACHE = {}  # (ref_file, mtime) -> total genome size
 
 
 def assign_interval(data):
@@ -37,11 +64,9 @@ def assign_interval(data):
     if not dd.get_coverage_interval(data):
         vrs = dd.get_variant_regions_merged(data)
         callable_file = dd.get_sample_callable(data)
-        if vrs:
-            callable_size = pybedtools.BedTool(vrs).total_coverage()
-        else:
-            callable_size = pybedtools.BedTool(callable_file).total_coverage()
-        total_size = sum([c.size for c in ref.file_contigs(dd.get_ref_file(data), data["config"])])
+        with shared.bedtools_tmpdir(data):
+            callable_size = _fast_total_coverage(vrs or callable_file)
+        total_size = _total_genome_size(data)
         genome_cov_pct = callable_size / float(total_size)
         if genome_cov_pct > GENOME_COV_THRESH:
             cov_interval = "genome"
@@ -61,6 +86,38 @@ def assign_interval(data):
         data["config"]["algorithm"]["coverage_interval"] = cov_interval
     return data
 
+def _fast_total_coverage(bed_file):
+    """Total bases covered by a BED file, avoiding bedtools startup costs for small files.
+    """
+    if os.path.getsize(bed_file) < SMALL_BED_SIZE:
+        return _bed_total_coverage(bed_file)
+    else:
+        return pybedtools.BedTool(bed_file).total_coverage()
+
+def _bed_total_coverage(bed_file):
+    """Total bases covered by a BED file, merging overlapping regions.
+    """
+    total = 0
+    for regions in _read_bed_by_chrom(bed_file).values():
+        cur_start, cur_end = regions[0]
+        for start, end in regions[1:]:
+            if start > cur_end:
+                total += cur_end - cur_start
+                cur_start, cur_end = start, end
+            else:
+                cur_end = max(cur_end, end)
+        total += cur_end - cur_start
+    return total
+
+def _total_genome_size(data):
+    """Retrieve total size of reference contigs, memoized on reference file and modification time.
+    """
+    ref_file = dd.get_ref_file(data)
+    key = (ref_file, os.path.getmtime(ref_file))
+    if key not in _TOTAL_SIZE_CACHE:
+        _TOTAL_SIZE_CACHE[key] = sum([c.size for c in ref.file_contigs(ref_file, data["config"])])
+    return _TOTAL_SIZE_CACHE[key]
+
 def _count_offtarget(data, bam_file, bed_file, target_name):
     mapped_unique = readstats.number_of_mapped_reads(data, bam_file, keep_dups=False)
     ontarget = readstats.number_of_mapped_reads(
@@ -81,35 +138,93 @@ def calculate(bam_file, data, sv_bed):
     if not variant_regions:
         variant_regions = _create_genome_regions(data)
     # Back compatible with previous pre-mosdepth callable files
-    callable_file = os.path.join(utils.safe_makedir(os.path.join(dd.get_work_dir(data), "align",
-                                                                 dd.get_sample_name(data))),
-                                 "%s-coverage.callable.bed" % (dd.get_sample_name(data)))
+    sample = dd.get_sample_name(data)
+    callable_file = os.path.join(utils.safe_makedir(os.path.join(dd.get_work_dir(data), "align", sample)),
+                                 "%s-coverage.callable.bed" % (sample))
     if not utils.file_uptodate(callable_file, bam_file):
         vr_quantize = ("0:1:%s:" % (params["min"]), ["NO_COVERAGE", "LOW_COVERAGE", "CALLABLE"])
         to_calculate = [("variant_regions", variant_regions,
-                         vr_quantize, None, "coverage_perbase" in dd.get_tools_on(data)),
+                         vr_quantize, None, "coverage_perbase" in dd.get_tools_on(data), False),
                         ("sv_regions", bedutils.clean_file(sv_bed, data, prefix="svregions-"),
-                         None, None, False),
+                         None, None, False, True),
                         ("coverage", bedutils.clean_file(dd.get_coverage(data), data, prefix="cov-"),
-                         None, DEPTH_THRESHOLDS, False)]
+                         None, DEPTH_THRESHOLDS, False, True)]
+        to_calculate = [xs for xs in to_calculate if xs[1]]
+        # targets sharing identical regions use a single mosdepth run with combined outputs
+        groups = _group_identical_regions(to_calculate)
+        # mosdepth runs are independent external processes reading the same BAM, so run them together
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(groups))) as executor:
+            futures = []
+            for group in groups:
+                target_name, region_bed = group[0][:2]
+                quantize = next((xs[2] for xs in group if xs[2]), None)
+                thresholds = next((xs[3] for xs in group if xs[3]), None)
+                per_base = any(xs[4] for xs in group)
+                futures.append((group, executor.submit(run_mosdepth, data, target_name, region_bed,
+                                                       quantize=quantize, thresholds=thresholds, per_base=per_base,
+                                                       fast=group[0][5], parallel_factor=len(groups))))
+            depth_infos = {}
+            for group, f in futures:
+                depth_info = f.result()
+                for target_name, _, quantize, thresholds, per_base, _ in group:
+                    depth_infos[target_name] = _copy_mosdepth_outputs(depth_info, group[0][0], target_name, sample,
+                                                                      quantize, thresholds, per_base)
+        depth_infos = collections.OrderedDict((xs[0], depth_infos[xs[0]]) for xs in to_calculate)
         depth_files = {}
-        for target_name, region_bed, quantize, thresholds, per_base in to_calculate:
-            if region_bed:
-                cur_depth = {}
-                depth_info = run_mosdepth(data, target_name, region_bed, quantize=quantize, thresholds=thresholds,
-                                          per_base=per_base)
-                for attr in ("dist", "regions", "thresholds", "per_base"):
-                    val = getattr(depth_info, attr, None)
-                    if val:
-                        cur_depth[attr] = val
-                depth_files[target_name] = cur_depth
-                if target_name == "variant_regions":
-                    callable_file = depth_info.quantize
+        for target_name, depth_info in depth_infos.items():
+            cur_depth = {}
+            for attr in ("dist", "regions", "thresholds", "per_base"):
+                val = getattr(depth_info, attr, None)
+                if val:
+                    cur_depth[attr] = val
+            depth_files[target_name] = cur_depth
+            if target_name == "variant_regions":
+                callable_file = depth_info.quantize
     else:
         depth_files = {}
     final_callable = _subset_to_variant_regions(callable_file, variant_regions, data)
     return final_callable, depth_files
 
+def _group_identical_regions(to_calculate):
+    """Group coverage targets with identical region BED files, preserving input order.
+
+    Only groups targets with the same quantize, per-base and fast mode settings, since
+    these determine mosdepth MAPQ filtering and mate overlap correction.
+    """
+    groups = []
+    for xs in to_calculate:
+        for group in groups:
+            region_bed, quantize, per_base, fast = group[0][1], group[0][2], group[0][4], group[0][5]
+            if (quantize == xs[2] and per_base == xs[4] and fast == xs[5] and
+                  (os.path.realpath(region_bed) == os.path.realpath(xs[1]) or
+                   filecmp.cmp(region_bed, xs[1], shallow=False))):
+                group.append(xs)
+                break
+        else:
+            groups.append([xs])
+    return groups
+
+def _copy_mosdepth_outputs(depth_info, orig_target, target_name, sample, quantize, thresholds, per_base):
+    """Provide mosdepth outputs from a combined run under the file names for target_name.
+
+    Only includes the quantized, threshold and per-base outputs requested for the target.
+    """
+    depth_info = depth_info._replace(quantize=depth_info.quantize if quantize else None,
+                                     thresholds=depth_info.thresholds if thresholds else None,
+                                     per_base=depth_info.per_base if per_base else None)
+    if target_name == orig_target:
+        return depth_info
+    orig_prefix, new_prefix = "%s-%s." % (sample, orig_target), "%s-%s." % (sample, target_name)
+    out = {}
+    for attr, orig_file in depth_info._asdict().items():
+        if orig_file:
+            new_file = os.path.join(os.path.dirname(orig_file),
+                                    os.path.basename(orig_file).replace(orig_prefix, new_prefix, 1))
+            if not utils.file_uptodate(new_file, orig_file):
+                shutil.copy(orig_file, new_file)
+            out[attr] = new_file
+    return depth_info._replace(**out)
+
 def _create_genome_regions(data):
     """Create whole genome contigs we want to process, only non-alts.
 
@@ -129,27 +244,122 @@ def _subset_to_variant_regions(callable_file, variant_regions, data):
     out_file = "%s-vrsubset.bed" % utils.splitext_plus(callable_file)[0]
     if not utils.file_uptodate(out_file, callable_file):
         with file_transaction(data, out_file) as tx_out_file:
-            with utils.open_gzipsafe(callable_file) as in_handle:
-                pybedtools.BedTool(in_handle).intersect(variant_regions).saveas(tx_out_file)
+            try:
+                with utils.open_gzipsafe(callable_file) as in_handle:
+                    with open(tx_out_file, "w") as out_handle:
+                        _intersect_sorted(in_handle, variant_regions, out_handle)
+            except ValueError:
+                with shared.bedtools_tmpdir(data):
+                    with utils.open_gzipsafe(callable_file) as in_handle:
+                        pybedtools.BedTool(in_handle).intersect(variant_regions).saveas(tx_out_file)
     return out_file
 
+def _read_bed_by_chrom(bed_file):
+    """Retrieve (start, end) intervals from a BED file, grouped by chromosome and sorted by start.
+    """
+    regions = collections.defaultdict(list)
+    with utils.open_gzipsafe(bed_file) as in_handle:
+        for line in in_handle:
+            if line.strip() and not line.startswith(("#", "track", "browser")):
+                chrom, start, end = line.split("\t", 3)[:3]
+                regions[chrom].append((int(start), int(end)))
+    for chrom in regions:
+        regions[chrom].sort()
+    return regions
+
+def _intersect_sorted(in_handle, bed_file, out_handle):
+    """Sweep-line intersection of position sorted BED lines with a BED file of regions.
+
+    Matches bedtools intersect output, writing each input region trimmed to every
+    overlapping target region. Raises ValueError when inputs are not position sorted
+    within a chromosome, so callers can fall back to bedtools.
+    """
+    targets = _read_bed_by_chrom(bed_file)
+    cur_chrom, cur_targets, i, last_start = None, [], 0, -1
+    for line in in_handle:
+        if not line.strip() or line.startswith(("#", "track", "browser")):
+            continue
+        parts = line.rstrip("\r\n").split("\t")
+        chrom, start, end = parts[0], int(parts[1]), int(parts[2])
+        if chrom != cur_chrom:
+            cur_chrom, cur_targets, i, last_start = chrom, targets.get(chrom, []), 0, -1
+        if start < last_start:
+            raise ValueError("Input BED not sorted by position: %s:%s" % (chrom, start))
+        last_start = start
+        while i < len(cur_targets) and cur_targets[i][1] <= start:
+            i += 1
+        j = i
+        while j < len(cur_targets) and cur_targets[j][0] < end:
+            t_start, t_end = cur_targets[j]
+            if t_end > start:
+                out_handle.write("\t".join([chrom, str(max(start, t_start)), str(min(end, t_end))] + parts[3:]) + "\n")
+            j += 1
+
 def _get_cache_file(data, target_name):
-    prefix = os.path.join(
-        utils.safe_makedir(os.path.join(dd.get_work_dir(data), "align", dd.get_sample_name(data))),
-        "%s-coverage" % (dd.get_sample_name(data)))
+    sample = dd.get_sample_name(data)
+    prefix = os.path.join(utils.safe_makedir(os.path.join(dd.get_work_dir(data), "align", sample)),
+                          "%s-coverage" % (sample))
     cache_file = prefix + "-" + target_name + "-stats.yaml"
     return cache_file
 
+if msgspec:
+    class CoverageCache(msgspec.Struct):
+        """Typed coverage statistics cache, decoded without intermediate dictionaries.
+        """
+        avg_coverage: int
+        bam_content_digest: typing.Union[str, msgspec.UnsetType] = msgspec.UNSET
+
+def _cache_msgpack_path(cache_file):
+    """Binary msgpack sidecar for a YAML stats cache, faster to load than YAML.
+    """
+    return os.path.splitext(cache_file)[0] + ".stats.mp"
+
+def _cache_json_path(cache_file):
+    """Readable JSON sidecar for a YAML stats cache, decoded with msgspec.
+    """
+    return os.path.splitext(cache_file)[0] + ".json"
+
 def _read_cache(cache_file, reuse_cmp_files):
     reuse_cmp_file = [fn for fn in reuse_cmp_files if fn]
-    if all(utils.file_uptodate(cache_file, fn) for fn in reuse_cmp_file):
+
+    def _is_current(fname):
+        return utils.file_exists(fname) and all(utils.file_uptodate(fname, fn) for fn in reuse_cmp_file)
+    json_file = _cache_json_path(cache_file)
+    if msgspec and _is_current(json_file) and utils.file_uptodate(json_file, cache_file):
+        try:
+            with open(json_file, "rb") as in_handle:
+                cache = msgspec.structs.asdict(msgspec.json.decode(in_handle.read(), type=CoverageCache))
+            return {k: v for k, v in cache.items() if v is not msgspec.UNSET}
+        except msgspec.DecodeError:
+            pass
+    mp_file = _cache_msgpack_path(cache_file)
+    # sidecar mirrors the YAML cache, so ignore it if the YAML was edited afterwards
+    if msgpack and _is_current(mp_file) and utils.file_uptodate(mp_file, cache_file):
+        try:
+            with open(mp_file, "rb") as in_handle:
+                return msgpack.unpack(in_handle, raw=False)
+        except (ValueError, msgpack.exceptions.UnpackException):
+            pass
+    if utils.file_exists(cache_file) and all(utils.file_uptodate(cache_file, fn) for fn in reuse_cmp_file):
         with open(cache_file) as in_handle:
             return yaml.safe_load(in_handle)
     return dict()
 
-def _write_cache(cache, cache_file):
+def _write_cache(cache, cache_file, data):
     with open(cache_file, "w") as out_handle:
         yaml.safe_dump(cache, out_handle, default_flow_style=False, allow_unicode=False)
+    if msgpack:
+        with file_transaction(data, _cache_msgpack_path(cache_file)) as tx_mp_file:
+            with open(tx_mp_file, "wb") as out_handle:
+                msgpack.pack(cache, out_handle, use_bin_type=True)
+    json_file = _cache_json_path(cache_file)
+    if msgspec and set(cache.keys()) <= set(CoverageCache.__struct_fields__):
+        with file_transaction(data, json_file) as tx_json_file:
+            with open(tx_json_file, "wb") as out_handle:
+                out_handle.write(msgspec.json.encode(CoverageCache(**cache)))
+    else:
+        # cache contents do not fit the typed JSON sidecar, so avoid leaving a stale copy
+        utils.remove_safe(json_file)
 
 def get_average_coverage(target_name, bed_file, data, bam_file=None):
     if not bam_file:
@@ -157,10 +367,19 @@ def get_average_coverage(target_name, bed_file, data, bam_file=None):
 
     cache_file = _get_cache_file(data, target_name)
 
+    bam_digest = None
     if dd.get_disambiguate(data):
         cache = _read_cache(cache_file, [bed_file])
     else:
         cache = _read_cache(cache_file, [bam_file, bed_file])
+        # BAM rewritten with unchanged alignments, like added read groups, can still reuse the cache
+        if "avg_coverage" not in cache and bam_file and utils.file_exists(bam_file):
+            bam_digest = _bam_content_digest(bam_file)
+            prev_cache = _read_cache(cache_file, [bed_file])
+            if bam_digest and "avg_coverage" in prev_cache and prev_cache.get("bam_content_digest") == bam_digest:
+                # rewrite so later calls find the cache up to date with the BAM
+                _write_cache(prev_cache, cache_file, data)
+                cache = prev_cache
 
     if "avg_coverage" in cache:
         return int(cache["avg_coverage"])
@@ -171,23 +390,114 @@ def get_average_coverage(target_name, bed_file, data, bam_file=None):
         avg_cov = _average_genome_coverage(data, bam_file)
 
     cache["avg_coverage"] = int(avg_cov)
-    _write_cache(cache, cache_file)
+    if not bam_digest and bam_file and utils.file_exists(bam_file):
+        bam_digest = _bam_content_digest(bam_file)
+    if bam_digest:
+        cache["bam_content_digest"] = bam_digest
+    _write_cache(cache, cache_file, data)
     return int(avg_cov)
 
+def _bam_content_digest(bam_file, max_contigs=32, reads_per_window=100):
+    """Quick digest of BAM alignments from index read counts and reads sampled in each contig.
+
+    Uses reference names and lengths, mapped and unmapped read counts per contig from
+    the index, and positions, flags, mapping qualities and CIGARs of reads at the start
+    and middle of up to max_contigs contigs. Ignores other header lines and read tags,
+    so BAMs rewritten with new read groups still match. Avoids reading the full file, so
+    changes to reads outside the sampled windows that keep per contig read counts are
+    not detected. Returns None for BAMs without an index.
+    """
+    with pysam.AlignmentFile(bam_file, "rb") as pysam_bam:
+        if not pysam_bam.has_index():
+            return None
+        stats = pysam_bam.get_index_statistics()
+        digest = hashlib.blake2b(repr([(x.contig, pysam_bam.get_reference_length(x.contig), x.mapped, x.unmapped)
+                                       for x in stats]).encode("utf-8"))
+        contigs = [x.contig for x in stats if x.mapped > 0]
+        for contig in contigs[::max(1, -(-len(contigs) // max_contigs))]:
+            for start in [0, pysam_bam.get_reference_length(contig) // 2]:
+                for a in itertools.islice(pysam_bam.fetch(contig, start), reads_per_window):
+                    digest.update(repr((a.reference_start, a.flag, a.mapping_quality, a.cigarstring,
+                                        a.query_length)).encode("utf-8"))
+    return digest.hexdigest()
+
 def _average_genome_coverage(data, bam_file):
     """Quickly calculate average coverage for whole genome files using indices.
 
-    Includes all reads, with duplicates. Uses sampling of 10M reads.
+    Includes all reads, with duplicates. Estimates read size from reads in random
+    windows across contigs, weighted by aligned reads.
     """
-    total = sum([c.size for c in ref.file_contigs(dd.get_ref_file(data), data["config"])])
-    read_counts = sum(x.aligned for x in bam.idxstats(bam_file, data))
-    with pysam.Samfile(bam_file, "rb") as pysam_bam:
-        read_size = np.median(list(itertools.islice((a.query_length for a in pysam_bam.fetch()), int(1e7))))
+    total = _total_genome_size(data)
+    idxstats = bam.idxstats(bam_file, data)
+    read_counts = sum(x.aligned for x in idxstats)
+    # take the median from a histogram of read length counts, sized to the longest read
+    with pysam.AlignmentFile(bam_file, "rb", threads=min(4, dd.get_cores(data))) as pysam_bam:
+        lengths = np.fromiter(_sample_read_lengths(pysam_bam, idxstats), dtype=np.int32)
+        if len(lengths) == 0:
+            lengths = np.fromiter((a.query_length for a in
+                                   itertools.islice(pysam_bam.fetch(until_eof=True), int(1e7))), dtype=np.int32)
+    bins = np.bincount(lengths, minlength=1)
+    csum = bins.cumsum()
+    num_reads = csum[-1]
+    read_size = (np.searchsorted(csum, (num_reads + 1) // 2) + np.searchsorted(csum, num_reads // 2 + 1)) / 2.0 \
+        if num_reads else 0
     avg_cov = float(read_counts * read_size) / total
     return avg_cov
 
+def _sample_read_lengths(pysam_bam, idxstats, num_windows=20, window_size=5000, reads_per_window=5000):
+    """Retrieve read lengths from random windows in contigs, chosen proportional to aligned reads.
+
+    Avoids biasing read size estimates towards the start of the first contig.
+    Uses a fixed seed so estimates are reproducible between runs.
+    """
+    contigs = [x for x in idxstats if x.aligned > 0 and x.length > 0]
+    if not contigs:
+        return
+    rs = np.random.RandomState(42)
+    weights = np.array([x.aligned for x in contigs], dtype=np.float64)
+    for i in rs.choice(len(contigs), size=num_windows, p=weights / weights.sum()):
+        contig = contigs[i]
+        start = rs.randint(0, max(1, contig.length - window_size))
+        for a in itertools.islice(pysam_bam.fetch(contig.contig, start, start + window_size), reads_per_window):
+            yield a.query_length
+
 def _average_bed_coverage(bed_file, target_name, data):
-    depth_file = regions_coverage(bed_file, target_name, data)
+    depth_file = regions_coverage(bed_file, target_name, data, fast=True)
+    summary_file = depth_file.replace(".regions.bed.gz", ".mosdepth.summary.txt")
+    summary = _read_mosdepth_summary(summary_file) if utils.file_uptodate(summary_file, depth_file) else {}
+    if "total_region" in summary:
+        return summary["total_region"]["mean"]
+    try:
+        return _average_region_depth(depth_file, min(4, dd.get_cores(data)))
+    except (pd.errors.ParserError, ValueError):
+        # lines with a varying number of columns, take depth from the last column of each line
+        return _average_region_depth_by_line(depth_file)
+
+def _average_region_depth(depth_file, threads):
+    """Length weighted average depth of mosdepth regions, reading only coordinates and depth.
+
+    Raises ParserError or ValueError on lines with a different number of columns than the first.
+    """
+    num_cols = 0
+    with utils.open_gzipsafe(depth_file) as in_handle:
+        for line in in_handle:
+            if line.strip() and not line.startswith("#"):
+                num_cols = len(line.rstrip("\r\n").split("\t"))
+                break
+    if not num_cols:
+        return 0
+    depth_col = num_cols - 1
+    with _open_gz_parallel(depth_file, threads) as in_handle:
+        df = pd.read_csv(in_handle, sep="\t", header=None, comment="#", engine="c", usecols=[1, 2, depth_col],
+                         dtype={1: np.int64, 2: np.int64, depth_col: np.float64})
+    sizes = df[2].values - df[1].values
+    depths = df[depth_col].values
+    if np.isnan(depths).any():
+        raise ValueError("Missing depth values in %s" % depth_file)
+    total_len = sizes.sum()
+    return float(np.dot(sizes, depths) / total_len) if total_len > 0 else 0
+
+def _average_region_depth_by_line(depth_file):
     avg_covs = []
     total_len = 0
     with utils.open_gzipsafe(depth_file) as fh:
@@ -197,61 +507,259 @@ def _average_bed_coverage(bed_file, target_name, data):
             size = end - start
             avg_covs.append(float(line_tokens[-1]) * size)
             total_len += size
-    avg_cov = sum(avg_covs) / total_len if total_len > 0 else 0
-    return avg_cov
+    return sum(avg_covs) / total_len if total_len > 0 else 0
+
+@contextlib.contextmanager
+def _open_gz_parallel(in_file, threads):
+    """Open a gzipped file for reading, decompressing with multiple threads when possible.
+
+    Uses pgzip if installed, then pigz, falling back to single threaded gzip.
+    """
+    if not in_file.endswith(".gz") or threads <= 1:
+        with utils.open_gzipsafe(in_file) as in_handle:
+            yield in_handle
+    elif pgzip:
+        with pgzip.open(in_file, "rt", thread=threads, blocksize=1 << 20) as in_handle:
+            yield in_handle
+    elif utils.which("pigz"):
+        cmd = ["pigz", "-dc", "-p", str(threads), in_file]
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            yield p.stdout
+        finally:
+            p.stdout.close()
+            p.wait()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, " ".join(cmd))
+    else:
+        with utils.open_gzipsafe(in_file) as in_handle:
+            yield in_handle
 
-def regions_coverage(bed_file, target_name, data):
+def regions_coverage(bed_file, target_name, data, fast=False):
     """Generate coverage over regions of interest using mosdepth.
     """
     ready_bed = tz.get_in(["depth", target_name, "regions"], data)
     if ready_bed:
         return ready_bed
     else:
-        return run_mosdepth(data, target_name, bed_file).regions
+        return run_mosdepth(data, target_name, bed_file, fast=fast).regions
 
-def run_mosdepth(data, target_name, bed_file, per_base=False, quantize=None, thresholds=None):
+def run_mosdepth(data, target_name, bed_file, per_base=False, quantize=None, thresholds=None, parallel_factor=1,
+                 fast=False):
     """Run mosdepth generating distribution, region depth and per-base depth.
+
+    parallel_factor splits available cores when running multiple mosdepth jobs concurrently.
+    fast skips mate overlap correction (mosdepth -x), for depths that do not need it,
+    unless coverage_fast_mode is in tools_off.
     """
-    MosdepthCov = collections.namedtuple("MosdepthCov", ("dist", "per_base", "regions", "quantize", "thresholds"))
+    MosdepthCov = collections.namedtuple("MosdepthCov", ("dist", "per_base", "regions", "quantize", "thresholds",
+                                                         "summary"))
     bam_file = dd.get_align_bam(data) or dd.get_work_bam(data)
-    work_dir = utils.safe_makedir(os.path.join(dd.get_work_dir(data), "coverage", dd.get_sample_name(data)))
-    prefix = os.path.join(work_dir, "%s-%s" % (dd.get_sample_name(data), target_name))
+    sample = dd.get_sample_name(data)
+    work_dir = utils.safe_makedir(os.path.join(dd.get_work_dir(data), "coverage", sample))
+    prefix = os.path.join(work_dir, "%s-%s" % (sample, target_name))
+    num_cores = max(1, dd.get_cores(data) // parallel_factor)
     old_dist_file = "%s.mosdepth.dist.txt" % (prefix)
     out = MosdepthCov((old_dist_file if utils.file_uptodate(old_dist_file, bam_file) else
                        "%s.mosdepth.%s.dist.txt" % (prefix, "region" if bed_file else "global")),
                       ("%s.per-base.bed.gz" % prefix) if per_base else None,
                       ("%s.regions.bed.gz" % prefix) if bed_file else None,
                       ("%s.quantized.bed.gz" % prefix) if quantize else None,
-                      ("%s.thresholds.bed.gz" % prefix) if thresholds else None)
-    if not utils.file_uptodate(out.dist, bam_file):
+                      ("%s.thresholds.bed.gz" % prefix) if thresholds else None,
+                      "%s.mosdepth.summary.txt" % prefix)
+    fast_arg = "-x" if fast and "coverage_fast_mode" not in dd.get_tools_off(data) else ""
+    params_file = "%s.mosdepth.params.digest" % prefix
+    params_digest = _mosdepth_params_digest(bam_file, bed_file, per_base, quantize, thresholds, fast_arg)
+    if utils.file_exists(params_file):
+        with open(params_file) as in_handle:
+            is_current = in_handle.read().strip() == params_digest and all(utils.file_exists(f) for f in out if f)
+    else:
+        is_current = utils.file_uptodate(out.dist, bam_file)
+    if not is_current:
         with file_transaction(data, out.dist) as tx_out_file:
             tx_prefix = os.path.join(os.path.dirname(tx_out_file), os.path.basename(prefix))
-            num_cores = dd.get_cores(data)
-            bed_arg = ("--by %s" % bed_file) if bed_file else ""
-            perbase_arg = "" if per_base else "--no-per-base"
-            mapq_arg = "-Q 1" if (per_base or quantize) else ""
             if quantize:
                 quant_arg = "--quantize %s" % quantize[0]
                 quant_export = " && ".join(["export MOSDEPTH_Q%s=%s" % (i, x) for (i, x) in enumerate(quantize[1])])
                 quant_export += " && "
             else:
                 quant_arg, quant_export = "", ""
+            cmd_args = {"quant_export": quant_export, "num_cores": num_cores,
+                        "mapq_arg": "-Q 1" if (per_base or quantize) else "", "fast_arg": fast_arg,
+                        "perbase_arg": "" if per_base else "--no-per-base",
+                        "bed_arg": ("--by %s" % bed_file) if bed_file else "", "quant_arg": quant_arg,
+                        "tx_prefix": tx_prefix, "bam_file": bam_file,
+                        "thresholds_cmdl": ("-T " + ",".join([str(t) for t in thresholds])) if thresholds else ""}
+            cmd = ("{quant_export}mosdepth -t {num_cores} -F 1804 {mapq_arg} {fast_arg} {perbase_arg} {bed_arg} "
+                   "{quant_arg} {tx_prefix} {bam_file} {thresholds_cmdl}")
+            message = "Calculating coverage: %s %s" % (sample, target_name)
+            # per-chromosome runs only report per-base depth for BED chromosomes, so keep whole genome runs
+            by_chrom = _read_bed_lines_by_chrom(bed_file) if bed_file and not per_base and \
+                num_cores > 2 * MOSDEPTH_SHARD_CORES else {}
+            if by_chrom and len(by_chrom) <= MOSDEPTH_MAX_SHARDS:
+                _run_mosdepth_by_chrom(cmd, cmd_args, by_chrom, prefix, tx_out_file, out, message, data)
+            else:
+                do.run(cmd.format(**cmd_args), message)
+            for out_file in [out.per_base, out.regions, out.quantize, out.thresholds, out.summary]:
+                if out_file:
+                    shutil.move(os.path.join(os.path.dirname(tx_out_file), os.path.basename(out_file)), out_file)
+        with open(params_file, "w") as out_handle:
+            out_handle.write(params_digest + "\n")
+    return out
+
+def _read_mosdepth_summary(summary_file):
+    """Parse a mosdepth summary file into per contig dictionaries of length, bases and mean depth.
 
-            thresholds_cmdl = ("-T " + ",".join([str(t) for t in thresholds])) if out.thresholds else ""
-            cmd = ("{quant_export}mosdepth -t {num_cores} -F 1804 {mapq_arg} {perbase_arg} {bed_arg} {quant_arg} "
-                   "{tx_prefix} {bam_file} {thresholds_cmdl}")
-            message = "Calculating coverage: %s %s" % (dd.get_sample_name(data), target_name)
-            do.run(cmd.format(**locals()), message.format(**locals()))
-            if out.per_base:
-                shutil.move(os.path.join(os.path.dirname(tx_out_file), os.path.basename(out.per_base)), out.per_base)
-            if out.regions:
-                shutil.move(os.path.join(os.path.dirname(tx_out_file), os.path.basename(out.regions)), out.regions)
-            if out.quantize:
-                shutil.move(os.path.join(os.path.dirname(tx_out_file), os.path.basename(out.quantize)), out.quantize)
-            if out.thresholds:
-                shutil.move(os.path.join(os.path.dirname(tx_out_file), os.path.basename(out.thresholds)), out.thresholds)
+    Includes total and total_region rows, returning an empty dictionary if the summary is missing.
+    """
+    out = {}
+    if summary_file and utils.file_exists(summary_file):
+        with open(summary_file) as in_handle:
+            for line in in_handle:
+                if not line.startswith("chrom\t"):
+                    parts = line.rstrip("\r\n").split("\t")
+                    out[parts[0]] = {"length": int(parts[1]), "bases": int(parts[2]), "mean": float(parts[3]),
+                                     "min": int(parts[4]), "max": int(parts[5])}
     return out
 
+def _read_bed_lines_by_chrom(bed_file):
+    """Retrieve BED lines grouped by chromosome, in input order.
+    """
+    by_chrom = collections.OrderedDict()
+    with utils.open_gzipsafe(bed_file) as in_handle:
+        for line in in_handle:
+            if line.strip() and not line.startswith(("#", "track", "browser")):
+                by_chrom.setdefault(line.split("\t", 1)[0], []).append(line)
+    return by_chrom
+
+def _run_mosdepth_by_chrom(cmd, cmd_args, by_chrom, prefix, tx_out_file, out, message, data):
+    """Run mosdepth in parallel on each chromosome of BED lines, merging outputs.
+
+    Parallelizes beyond the mosdepth threading limit on machines with many cores.
+    Merges region, quantized and threshold outputs by concatenating BGZF files,
+    combines distributions weighted by the region size of each chromosome and sums
+    summary statistics. Only chromosomes in the BED file are processed, so the
+    summary total row excludes reads on other chromosomes.
+    """
+    tx_prefix = cmd_args["tx_prefix"]
+    shard_dir = utils.safe_makedir(tx_prefix + "-bychrom")
+    shards = []
+    for i, (chrom, lines) in enumerate(by_chrom.items()):
+        shard_prefix = os.path.join(shard_dir, "shard%04d" % i)
+        with open(shard_prefix + ".bed", "w") as out_handle:
+            out_handle.write("".join(lines))
+        size = sum(int(x.split("\t", 3)[2]) - int(x.split("\t", 3)[1]) for x in lines)
+        shard_args = dict(cmd_args, num_cores=MOSDEPTH_SHARD_CORES, tx_prefix=shard_prefix,
+                          bed_arg="--by %s -c %s" % (shard_prefix + ".bed", shlex.quote(chrom)))
+        shards.append((shard_prefix, chrom, size, cmd.format(**shard_args), "%s %s" % (message, chrom)))
+    num_workers = max(1, cmd_args["num_cores"] // MOSDEPTH_SHARD_CORES)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for f in [executor.submit(do.run, shard_cmd, shard_msg) for _, _, _, shard_cmd, shard_msg in shards]:
+            f.result()
+    for out_file in [out.regions, out.quantize, out.thresholds]:
+        if out_file:
+            ext = out_file[len(prefix):]
+            _concat_bgzip_beds([x[0] + ext for x in shards], tx_prefix + ext, data)
+    ext = out.dist[len(prefix):]
+    _merge_mosdepth_dists([(x[0] + ext, x[2]) for x in shards], tx_out_file)
+    ext = out.summary[len(prefix):]
+    _merge_mosdepth_summaries([(x[0] + ext, x[1]) for x in shards], tx_prefix + ext)
+
+def _concat_bgzip_beds(in_files, out_file, data):
+    """Concatenate BGZF compressed BED files, keeping only the header line of the first file.
+
+    Files without headers are concatenated directly, and headers of remaining files
+    are removed with a single recompression of all of them.
+    """
+    has_header = _has_bed_header(in_files[0])
+    with open(out_file, "wb") as out_handle:
+        for in_file in in_files[:1] if has_header else in_files:
+            with open(in_file, "rb") as in_handle:
+                shutil.copyfileobj(in_handle, out_handle)
+    if has_header and len(in_files) > 1:
+        bgzip = tools.get_bgzip_cmd(data["config"])
+        rest_files = " ".join(in_files[1:])
+        do.run("zcat {rest_files} | sed '/^#/d' | {bgzip} -c >> {out_file}".format(**locals()),
+               "Merge mosdepth output %s" % os.path.basename(out_file))
+
+def _has_bed_header(in_file):
+    with utils.open_gzipsafe(in_file) as in_handle:
+        return in_handle.readline().startswith("#")
+
+def _merge_mosdepth_dists(dist_files, out_file):
+    """Merge mosdepth cumulative coverage distributions from per-chromosome runs.
+
+    Contig rows pass through unchanged and total rows are recalculated as the
+    region size weighted average of the per-chromosome totals.
+    """
+    totals = collections.defaultdict(float)
+    total_size = sum(size for _, size in dist_files)
+    with open(out_file, "w") as out_handle:
+        for dist_file, size in dist_files:
+            if not os.path.exists(dist_file):
+                raise IOError("Missing mosdepth distribution from per-chromosome run: %s" % dist_file)
+            with open(dist_file) as in_handle:
+                for line in in_handle:
+                    contig, depth, pct = line.strip().split("\t")
+                    if contig == "total":
+                        totals[int(depth)] += float(pct) * size
+                    else:
+                        out_handle.write(line)
+        for depth in sorted(totals.keys(), reverse=True):
+            pct = totals[depth] / total_size if total_size else 0.0
+            if pct >= 8e-5:
+                out_handle.write("total\t%s\t%.2f\n" % (depth, pct))
+
+def _merge_mosdepth_summaries(summary_files, out_file):
+    """Merge mosdepth summaries from per-chromosome runs.
+
+    Keeps the chromosome and region rows from the run for each chromosome and
+    recalculates total and total_region rows from them.
+    """
+    rows = []
+    for summary_file, chrom in summary_files:
+        if not os.path.exists(summary_file):
+            raise IOError("Missing mosdepth summary from per-chromosome run: %s" % summary_file)
+        summary = _read_mosdepth_summary(summary_file)
+        for name in [chrom, "%s_region" % chrom]:
+            if name in summary:
+                rows.append((name, summary[name]))
+    with open(out_file, "w") as out_handle:
+        out_handle.write("chrom\tlength\tbases\tmean\tmin\tmax\n")
+        totals = collections.OrderedDict()
+        for name, info in rows:
+            out_handle.write("%s\t%s\t%s\t%.2f\t%s\t%s\n" % (name, info["length"], info["bases"], info["mean"],
+                                                           info["min"], info["max"]))
+            total_name = "total_region" if name.endswith("_region") else "total"
+            cur = totals.setdefault(total_name, {"length": 0, "bases": 0, "min": info["min"], "max": info["max"]})
+            cur["length"] += info["length"]
+            cur["bases"] += info["bases"]
+            cur["min"] = min(cur["min"], info["min"])
+            cur["max"] = max(cur["max"], info["max"])
+        for name in ["total", "total_region"]:
+            if name in totals:
+                info = totals[name]
+                mean = float(info["bases"]) / info["length"] if info["length"] else 0.0
+                out_handle.write("%s\t%s\t%s\t%.2f\t%s\t%s\n" % (name, info["length"], info["bases"], mean,
+                                                               info["min"], info["max"]))
+
+def _mosdepth_params_digest(bam_file, bed_file, per_base, quantize, thresholds, fast_arg):
+    """Digest of mosdepth inputs and parameters, used to identify reusable outputs.
+
+    Identifies the BAM by its alignment content digest and the BED by its contents, so
+    touched or rewritten inputs with unchanged content reuse previous outputs. Falls
+    back to BAM size and modification time for BAMs without an index.
+    """
+    bam_info, bed_info = None, None
+    if bam_file and os.path.exists(bam_file):
+        bam_info = _bam_content_digest(bam_file) or (os.path.getsize(bam_file), os.path.getmtime(bam_file))
+    if bed_file and os.path.exists(bed_file):
+        with open(bed_file, "rb") as in_handle:
+            bed_info = hashlib.blake2b(in_handle.read()).hexdigest()
+    params = [("bam", bam_info), ("bed", bed_info), ("per_base", bool(per_base)),
+              ("quantize", quantize), ("thresholds", thresholds), ("fast", fast_arg)]
+    return hashlib.blake2b(repr(params).encode("utf-8")).hexdigest()
+
 def coverage_region_detailed_stats(target_name, bed_file, data, out_dir):
     """
     Calculate coverage at different completeness cutoff
@@ -0,0 +1,440 @@
+import collections
+import gzip
+import io
+import os
+
+import numpy as np
+import pytest
+
+from bcbio.variation import coverage
+
+
+def _write(tmpdir, name, lines):
+    fname = str(tmpdir.join(name))
+    with open(fname, "w") as out_handle:
+        out_handle.write("".join(lines))
+    return fname
+
+
+def _intersect(tmpdir, in_lines, target_lines):
+    target_file = _write(tmpdir, "targets.bed", target_lines)
+    out_handle = io.StringIO()
+    coverage._intersect_sorted(io.StringIO("".join(in_lines)), target_file, out_handle)
+    return out_handle.getvalue().splitlines(True)
+
+
+class TestIntersectSorted(object):
+    """Sorted intersection of callable regions matches bedtools intersect output.
+    """
+    def test_overlapping_targets(self, tmpdir):
+        out = _intersect(tmpdir, ["chr1\t0\t100\tCALLABLE\n"],
+                         ["chr1\t10\t50\n", "chr1\t40\t60\n", "chr1\t90\t120\n"])
+        assert out == ["chr1\t10\t50\tCALLABLE\n", "chr1\t40\t60\tCALLABLE\n", "chr1\t90\t100\tCALLABLE\n"]
+
+    def test_chrom_missing_from_targets(self, tmpdir):
+        out = _intersect(tmpdir, ["chr1\t0\t100\tCALLABLE\n", "chr2\t0\t100\tCALLABLE\n",
+                                  "chr3\t0\t100\tLOW_COVERAGE\n"],
+                         ["chr3\t50\t150\n", "chr1\t20\t30\n"])
+        assert out == ["chr1\t20\t30\tCALLABLE\n", "chr3\t50\t100\tLOW_COVERAGE\n"]
+
+    def test_extra_columns_and_no_overlap(self, tmpdir):
+        out = _intersect(tmpdir, ["chr1\t0\t10\tNO_COVERAGE\textra\n", "chr1\t10\t20\tCALLABLE\tmore\tcols\n",
+                                  "chr1\t30\t40\tCALLABLE\n"],
+                         ["chr1\t5\t15\tgene\n"])
+        assert out == ["chr1\t5\t10\tNO_COVERAGE\textra\n", "chr1\t10\t15\tCALLABLE\tmore\tcols\n"]
+
+    def test_unsorted_falls_back_to_bedtools(self, tmpdir, mocker):
+        data = {"config": {"resources": {"tmp": {"dir": str(tmpdir.join("tmp"))}}}}
+        callable_file = _write(tmpdir, "callable.bed", ["chr1\t50\t60\tCALLABLE\n", "chr1\t0\t10\tCALLABLE\n"])
+        target_file = _write(tmpdir, "targets.bed", ["chr1\t0\t100\n"])
+        bedtool = mocker.patch("bcbio.variation.coverage.pybedtools.BedTool")
+        out_file = coverage._subset_to_variant_regions(callable_file, target_file, data)
+        assert out_file == str(tmpdir.join("callable-vrsubset.bed"))
+        bedtool.return_value.intersect.assert_called_once_with(target_file)
+        saveas = bedtool.return_value.intersect.return_value.saveas
+        assert saveas.call_count == 1
+        assert os.path.basename(saveas.call_args[0][0]) == "callable-vrsubset.bed"
+
+
+class TestBedTotalCoverage(object):
+    """Python total coverage matches bedtools total_coverage, merging overlaps first.
+    """
+    def test_merges_overlaps(self, tmpdir):
+        bed_file = _write(tmpdir, "regions.bed", ["#header\n", "track name=x\n", "chr1\t0\t10\n", "chr1\t5\t20\tname\n",
+                                                  "chr1\t20\t25\n", "chr1\t30\t40\n", "chr2\t100\t150\n",
+                                                  "chr1\t2\t8\n"])
+        assert coverage._bed_total_coverage(bed_file) == 25 + 10 + 50
+
+    def test_empty(self, tmpdir):
+        bed_file = _write(tmpdir, "empty.bed", [])
+        assert coverage._bed_total_coverage(bed_file) == 0
+
+
+def _write_gz(fname, lines):
+    with gzip.open(fname, "wt") as out_handle:
+        out_handle.write("".join(lines))
+    return fname
+
+
+class TestMosdepthByChrom(object):
+    """Merging of per-chromosome mosdepth outputs.
+    """
+    def test_merge_dists(self, tmpdir):
+        dist1 = _write(tmpdir, "shard0.dist.txt", ["chr1\t2\t0.50\n", "chr1\t1\t1.00\n", "chr1\t0\t1.00\n",
+                                                   "total\t2\t0.50\n", "total\t1\t1.00\n", "total\t0\t1.00\n"])
+        dist2 = _write(tmpdir, "shard1.dist.txt", ["chr2\t1\t0.20\n", "chr2\t0\t1.00\n",
+                                                   "total\t1\t0.20\n", "total\t0\t1.00\n"])
+        out_file = str(tmpdir.join("merged.dist.txt"))
+        coverage._merge_mosdepth_dists([(dist1, 100), (dist2, 300)], out_file)
+        with open(out_file) as in_handle:
+            assert in_handle.read().splitlines() == [
+                "chr1\t2\t0.50", "chr1\t1\t1.00", "chr1\t0\t1.00", "chr2\t1\t0.20", "chr2\t0\t1.00",
+                "total\t2\t0.12", "total\t1\t0.40", "total\t0\t1.00"]
+
+    def test_merge_dists_missing_shard(self, tmpdir):
+        dist1 = _write(tmpdir, "shard0.dist.txt", ["chr1\t0\t1.00\n", "total\t0\t1.00\n"])
+        with pytest.raises(IOError):
+            coverage._merge_mosdepth_dists([(dist1, 100), (str(tmpdir.join("shard1.dist.txt")), 100)],
+                                           str(tmpdir.join("merged.dist.txt")))
+
+    def test_merge_summaries(self, tmpdir):
+        header = "chrom\tlength\tbases\tmean\tmin\tmax\n"
+        sum1 = _write(tmpdir, "shard0.summary.txt", [header, "chr1\t1000\t5000\t5.00\t0\t20\n",
+                                                     "chr1_region\t100\t1000\t10.00\t2\t20\n",
+                                                     "total\t1000\t5000\t5.00\t0\t20\n",
+                                                     "total_region\t100\t1000\t10.00\t2\t20\n"])
+        sum2 = _write(tmpdir, "shard1.summary.txt", [header, "chr2\t500\t500\t1.00\t0\t5\n",
+                                                     "chr2_region\t300\t450\t1.50\t1\t5\n",
+                                                     "total\t500\t500\t1.00\t0\t5\n",
+                                                     "total_region\t300\t450\t1.50\t1\t5\n"])
+        out_file = str(tmpdir.join("merged.summary.txt"))
+        coverage._merge_mosdepth_summaries([(sum1, "chr1"), (sum2, "chr2")], out_file)
+        summary = coverage._read_mosdepth_summary(out_file)
+        assert summary["total"] == {"length": 1500, "bases": 5500, "mean": 3.67, "min": 0, "max": 20}
+        assert summary["total_region"] == {"length": 400, "bases": 1450, "mean": 3.62, "min": 1, "max": 20}
+        assert summary["chr2_region"]["mean"] == 1.5
+
+    def test_concat_thresholds_single_header(self, tmpdir, mocker):
+        mocker.patch("bcbio.variation.coverage.tools.get_bgzip_cmd", return_value="gzip")
+        header = "#chrom\tstart\tend\tregion\t1X\n"
+        in_files = [_write_gz(str(tmpdir.join("shard%s.thresholds.bed.gz" % i)),
+                              [header, "chr%s\t0\t10\tunknown\t%s\n" % (i + 1, i + 5)]) for i in range(3)]
+        out_file = str(tmpdir.join("merged.thresholds.bed.gz"))
+        coverage._concat_bgzip_beds(in_files, out_file, {"config": {}})
+        with gzip.open(out_file, "rt") as in_handle:
+            assert in_handle.read().splitlines() == [header.strip(), "chr1\t0\t10\tunknown\t5",
+                                                     "chr2\t0\t10\tunknown\t6", "chr3\t0\t10\tunknown\t7"]
+
+
+class TestGroupIdenticalRegions(object):
+    def test_groups_only_matching_settings(self, tmpdir):
+        vr_bed = _write(tmpdir, "vr.bed", ["chr1\t0\t100\n"])
+        cov_bed = _write(tmpdir, "cov-vr.bed", ["chr1\t0\t100\n"])
+        sv_bed = _write(tmpdir, "svregions-vr.bed", ["chr1\t0\t100\n"])
+        other_bed = _write(tmpdir, "other.bed", ["chr1\t0\t200\n"])
+        quantize = ("0:1:4:", ["NO_COVERAGE", "LOW_COVERAGE", "CALLABLE"])
+        to_calculate = [("variant_regions", vr_bed, quantize, None, False, False),
+                        ("sv_regions", sv_bed, None, None, False, True),
+                        ("coverage", cov_bed, None, [1, 5], False, True),
+                        ("other", other_bed, None, None, False, True),
+                        ("slow", cov_bed, None, None, False, False)]
+        groups = coverage._group_identical_regions(to_calculate)
+        assert [[xs[0] for xs in group] for group in groups] == [["variant_regions"], ["sv_regions", "coverage"],
+                                                                 ["other"], ["slow"]]
+
+
+def _tmp_data(tmpdir):
+    return {"config": {"resources": {"tmp": {"dir": str(tmpdir.join("tmp"))}}}}
+
+
+class TestStatsCache(object):
+    """Coverage stats cache sidecars stay consistent with the YAML cache.
+    """
+    def test_roundtrip_without_default_fields(self, tmpdir):
+        cache_file = str(tmpdir.join("s-coverage-variant_regions-stats.yaml"))
+        coverage._write_cache({"avg_coverage": 30}, cache_file, _tmp_data(tmpdir))
+        assert coverage._read_cache(cache_file, []) == {"avg_coverage": 30}
+
+    def test_extra_keys_replace_typed_sidecar(self, tmpdir):
+        cache_file = str(tmpdir.join("s-coverage-variant_regions-stats.yaml"))
+        coverage._write_cache({"avg_coverage": 30}, cache_file, _tmp_data(tmpdir))
+        coverage._write_cache({"avg_coverage": 40, "other": 1}, cache_file, _tmp_data(tmpdir))
+        assert coverage._read_cache(cache_file, []) == {"avg_coverage": 40, "other": 1}
+
+    def test_edited_yaml_takes_precedence(self, tmpdir):
+        cache_file = str(tmpdir.join("s-coverage-variant_regions-stats.yaml"))
+        coverage._write_cache({"avg_coverage": 30}, cache_file, _tmp_data(tmpdir))
+        with open(cache_file, "w") as out_handle:
+            out_handle.write("avg_coverage: 99\n")
+        mtime = os.path.getmtime(cache_file) + 10
+        os.utime(cache_file, (mtime, mtime))
+        assert coverage._read_cache(cache_file, []) == {"avg_coverage": 99}
+
+    def test_truncated_msgpack_falls_back(self, tmpdir):
+        cache_file = str(tmpdir.join("s-coverage-variant_regions-stats.yaml"))
+        coverage._write_cache({"avg_coverage": 30, "other": 1}, cache_file, _tmp_data(tmpdir))
+        mp_file = coverage._cache_msgpack_path(cache_file)
+        with open(mp_file, "rb") as in_handle:
+            content = in_handle.read()
+        with open(mp_file, "wb") as out_handle:
+            out_handle.write(content[:-1])
+        assert coverage._read_cache(cache_file, []) == {"avg_coverage": 30, "other": 1}
+
+
+class TestAverageBedCoverage(object):
+    def _prep(self, tmpdir, mocker):
+        depth_file = _write_gz(str(tmpdir.join("s-coverage.regions.bed.gz")),
+                               ["chr1\t0\t10\t2.0\n", "chr1\t10\t30\t5.0\n"])
+        summary_file = _write(tmpdir, "s-coverage.mosdepth.summary.txt",
+                              ["chrom\tlength\tbases\tmean\tmin\tmax\n", "total_region\t30\t300\t10.00\t0\t20\n"])
+        mocker.patch("bcbio.variation.coverage.regions_coverage", return_value=depth_file)
+        return depth_file, summary_file
+
+    def test_uses_current_summary(self, tmpdir, mocker):
+        self._prep(tmpdir, mocker)
+        assert coverage._average_bed_coverage("regions.bed", "coverage", {"config": {}}) == 10.0
+
+    def test_ignores_stale_summary(self, tmpdir, mocker):
+        depth_file, summary_file = self._prep(tmpdir, mocker)
+        mtime = os.path.getmtime(summary_file) + 10
+        os.utime(depth_file, (mtime, mtime))
+        assert coverage._average_bed_coverage("regions.bed", "coverage", {"config": {}}) == 4.0
+
+
+def _mosdepth_data(tmpdir, cores=1, tools_off=None):
+    bam_file = str(tmpdir.join("s.bam"))
+    if not os.path.exists(bam_file):
+        _write_bam(bam_file)
+    return {"align_bam": bam_file, "rgnames": {"sample": "s"}, "dirs": {"work": str(tmpdir.join("work"))},
+            "config": {"algorithm": {"num_cores": cores, "tools_off": tools_off or []},
+                       "resources": {"tmp": {"dir": str(tmpdir.join("tmp"))}}}}
+
+
+def _fake_mosdepth(cmds):
+    """Replace running mosdepth, recording commands and writing the requested outputs.
+    """
+    def _run(cmd, message):
+        cmds.append(cmd)
+        parts = cmd.split()
+        bam_index = max(i for i, x in enumerate(parts) if x.endswith(".bam"))
+        prefix = parts[bam_index - 1]
+        bed_file = parts[parts.index("--by") + 1] if "--by" in parts else None
+        chroms = []
+        if bed_file:
+            with open(bed_file) as in_handle:
+                chroms = sorted(set(line.split("\t")[0] for line in in_handle))
+        with open("%s.mosdepth.%s.dist.txt" % (prefix, "region" if bed_file else "global"), "w") as out_handle:
+            for chrom in chroms:
+                out_handle.write("%s\t0\t1.00\n" % chrom)
+            out_handle.write("total\t0\t1.00\n")
+        with open("%s.mosdepth.summary.txt" % prefix, "w") as out_handle:
+            out_handle.write("chrom\tlength\tbases\tmean\tmin\tmax\n")
+            for chrom in chroms:
+                out_handle.write("%s\t100\t1000\t10.00\t0\t20\n" % chrom)
+                out_handle.write("%s_region\t10\t100\t10.00\t0\t20\n" % chrom)
+        out_exts = [".regions.bed.gz"] if bed_file else []
+        if "--no-per-base" not in parts:
+            out_exts.append(".per-base.bed.gz")
+        if "-T" in parts:
+            out_exts.append(".thresholds.bed.gz")
+        for ext in out_exts:
+            _write_gz(prefix + ext, ["%s\t0\t10\t10\n" % chrom for chrom in chroms])
+    return _run
+
+
+class TestRunMosdepth(object):
+    def _run(self, tmpdir, mocker, bed_lines=None, **kwargs):
+        cmds = []
+        mocker.patch("bcbio.variation.coverage.do.run", side_effect=_fake_mosdepth(cmds))
+        data = kwargs.pop("data", None) or _mosdepth_data(tmpdir)
+        bed_file = _write(tmpdir, "regions.bed", bed_lines or ["chr1\t0\t10\n"])
+        out = coverage.run_mosdepth(data, "coverage", bed_file, **kwargs)
+        return out, cmds
+
+    def test_mate_overlap_correction_by_default(self, tmpdir, mocker):
+        out, cmds = self._run(tmpdir, mocker)
+        assert len(cmds) == 1 and "-x" not in cmds[0].split()
+        assert os.path.exists(out.regions) and os.path.exists(out.summary)
+
+    def test_fast_mode(self, tmpdir, mocker):
+        _, cmds = self._run(tmpdir, mocker, fast=True)
+        assert "-x" in cmds[0].split()
+
+    def test_fast_mode_turned_off(self, tmpdir, mocker):
+        data = _mosdepth_data(tmpdir, tools_off=["coverage_fast_mode"])
+        _, cmds = self._run(tmpdir, mocker, fast=True, data=data)
+        assert "-x" not in cmds[0].split()
+
+    def test_reuses_outputs_for_unchanged_content(self, tmpdir, mocker):
+        out, cmds = self._run(tmpdir, mocker)
+        _set_mtime([out.regions, out.dist, out.summary], -10)
+        _write_bam(str(tmpdir.join("s.bam")), read_group="rg1")
+        out, cmds = self._run(tmpdir, mocker)
+        assert cmds == []
+
+    def test_reruns_on_parameter_mismatch(self, tmpdir, mocker):
+        self._run(tmpdir, mocker)
+        _, cmds = self._run(tmpdir, mocker, fast=True)
+        assert len(cmds) == 1 and "-x" in cmds[0].split()
+
+    def test_no_sidecar_uses_modification_times(self, tmpdir, mocker):
+        out, _ = self._run(tmpdir, mocker)
+        os.remove("%s.mosdepth.params.digest" % out.dist.split(".mosdepth.")[0])
+        _, cmds = self._run(tmpdir, mocker)
+        assert cmds == []
+        _set_mtime([out.dist], -10)
+        _, cmds = self._run(tmpdir, mocker)
+        assert len(cmds) == 1
+
+    def test_shards_by_chromosome(self, tmpdir, mocker):
+        out, cmds = self._run(tmpdir, mocker, bed_lines=["chr1\t0\t10\n", "chr2\t0\t10\n"],
+                              data=_mosdepth_data(tmpdir, cores=16))
+        assert sorted(cmd.split()[cmd.split().index("-c") + 1] for cmd in cmds) == ["chr1", "chr2"]
+        assert sorted(coverage._read_mosdepth_summary(out.summary).keys()) == [
+            "chr1", "chr1_region", "chr2", "chr2_region", "total", "total_region"]
+
+    def test_no_shards_for_per_base(self, tmpdir, mocker):
+        out, cmds = self._run(tmpdir, mocker, bed_lines=["chr1\t0\t10\n", "chr2\t0\t10\n"],
+                              data=_mosdepth_data(tmpdir, cores=16), per_base=True)
+        assert len(cmds) == 1 and "-c" not in cmds[0].split()
+        assert os.path.exists(out.per_base)
+
+    def test_no_shards_for_many_chromosomes(self, tmpdir, mocker):
+        mocker.patch("bcbio.variation.coverage.MOSDEPTH_MAX_SHARDS", 1)
+        _, cmds = self._run(tmpdir, mocker, bed_lines=["chr1\t0\t10\n", "chr2\t0\t10\n"],
+                            data=_mosdepth_data(tmpdir, cores=16))
+        assert len(cmds) == 1 and "-c" not in cmds[0].split()
+
+
+def _write_bam(fname, read_group=None, flag_change=None):
+    """Write an indexed BAM with reads on two contigs, optionally tagged with a read group.
+    """
+    import pysam
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": "chr1", "LN": 10000}, {"SN": "chr2", "LN": 10000}]}
+    if read_group:
+        header["RG"] = [{"ID": read_group, "SM": "s"}]
+    with pysam.AlignmentFile(fname, "wb", header=header) as out_handle:
+        for ref_id in range(2):
+            for i, pos in enumerate(range(0, 9000, 50)):
+                a = pysam.AlignedSegment()
+                a.query_name = "r%s_%s" % (ref_id, i)
+                a.query_sequence = "A" * 100
+                a.query_qualities = pysam.qualitystring_to_array("I" * 100)
+                a.flag = 1024 if (ref_id, i) == flag_change else 0
+                a.reference_id = ref_id
+                a.reference_start = pos
+                a.mapping_quality = 60
+                a.cigartuples = [(0, 100)]
+                if read_group:
+                    a.set_tag("RG", read_group)
+                out_handle.write(a)
+    pysam.index(fname)
+    return fname
+
+
+def _set_mtime(fnames, offset):
+    for fname in fnames:
+        if os.path.exists(fname):
+            mtime = os.path.getmtime(fname) + offset
+            os.utime(fname, (mtime, mtime))
+
+
+class TestBamContentDigest(object):
+    def test_ignores_read_groups(self, tmpdir):
+        orig = coverage._bam_content_digest(_write_bam(str(tmpdir.join("orig.bam"))))
+        assert orig == coverage._bam_content_digest(_write_bam(str(tmpdir.join("rg.bam")), read_group="rg1"))
+
+    def test_detects_changed_alignments(self, tmpdir):
+        orig = coverage._bam_content_digest(_write_bam(str(tmpdir.join("orig.bam"))))
+        assert orig != coverage._bam_content_digest(_write_bam(str(tmpdir.join("mid.bam")), flag_change=(1, 100)))
+
+
+class TestAverageCoverageCache(object):
+    """Average coverage reuses caches for rewritten BAMs with unchanged alignments.
+    """
+    def _prep(self, tmpdir, mocker):
+        bam_file = _write_bam(str(tmpdir.join("s.bam")))
+        bed_file = _write(tmpdir, "regions.bed", ["chr1\t0\t1000\n"])
+        data = {"align_bam": bam_file, "rgnames": {"sample": "s"}, "dirs": {"work": str(tmpdir.join("work"))},
+                "config": {"algorithm": {}, "resources": {"tmp": {"dir": str(tmpdir.join("tmp"))}}}}
+        avg_cov = mocker.patch("bcbio.variation.coverage._average_bed_coverage", return_value=30)
+        assert coverage.get_average_coverage("coverage", bed_file, data) == 30
+        cache_file = coverage._get_cache_file(data, "coverage")
+        _set_mtime([bed_file], -20)
+        _set_mtime([cache_file, coverage._cache_msgpack_path(cache_file), coverage._cache_json_path(cache_file)],
+                   -10)
+        avg_cov.return_value = 40
+        return bam_file, bed_file, data, avg_cov, cache_file
+
+    def test_hit_refreshes_cache(self, tmpdir, mocker):
+        bam_file, bed_file, data, avg_cov, cache_file = self._prep(tmpdir, mocker)
+        _write_bam(bam_file, read_group="rg1")
+        assert coverage.get_average_coverage("coverage", bed_file, data) == 30
+        assert avg_cov.call_count == 1
+        assert all(coverage.utils.file_uptodate(cache_file, fn) for fn in [bam_file, bed_file])
+        digest = mocker.spy(coverage, "_bam_content_digest")
+        assert coverage.get_average_coverage("coverage", bed_file, data) == 30
+        assert digest.call_count == 0
+
+    def test_miss_recalculates(self, tmpdir, mocker):
+        bam_file, bed_file, data, avg_cov, _ = self._prep(tmpdir, mocker)
+        _write_bam(bam_file, flag_change=(0, 0))
+        assert coverage.get_average_coverage("coverage", bed_file, data) == 40
+        assert avg_cov.call_count == 2
+
+
+AlignInfo = collections.namedtuple("AlignInfo", ["contig", "length", "aligned", "unaligned"])
+FakeRead = collections.namedtuple("FakeRead", ["query_length"])
+
+
+class FakeAlignmentFile(object):
+    """Minimal pysam.AlignmentFile replacement returning read lengths by contig.
+    """
+    def __init__(self, lengths_by_contig, all_lengths=None):
+        self.lengths_by_contig = lengths_by_contig
+        self.all_lengths = all_lengths or []
+        self.fetched = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def fetch(self, contig=None, start=None, end=None, until_eof=False):
+        if until_eof:
+            return iter([FakeRead(x) for x in self.all_lengths])
+        self.fetched.append(contig)
+        return iter([FakeRead(x) for x in self.lengths_by_contig.get(contig, [])])
+
+
+class TestGenomeCoverage(object):
+    """Read size estimates for whole genome average coverage.
+    """
+    def _average(self, mocker, idxstats, pysam_bam):
+        mocker.patch("bcbio.variation.coverage.bam.idxstats", return_value=idxstats)
+        mocker.patch("bcbio.variation.coverage._total_genome_size", return_value=1000)
+        mocker.patch("bcbio.variation.coverage.pysam.AlignmentFile", return_value=pysam_bam)
+        return coverage._average_genome_coverage({"config": {"algorithm": {}}}, "s.bam")
+
+    def test_weighted_contig_choice(self):
+        idxstats = [AlignInfo("chr1", 100000, 990, 0), AlignInfo("chr2", 100000, 0, 0),
+                    AlignInfo("chr3", 100000, 10, 0), AlignInfo("chr4", 0, 100, 0)]
+        pysam_bam = FakeAlignmentFile({"chr1": [100], "chr3": [100]})
+        assert list(coverage._sample_read_lengths(pysam_bam, idxstats)) == [100] * 20
+        counts = collections.Counter(pysam_bam.fetched)
+        assert set(counts.keys()) <= {"chr1", "chr3"} and counts["chr1"] >= 15
+
+    def test_empty_windows_fall_back_to_file_start(self, mocker):
+        lengths = [50, 100, 100, 150, 300]
+        pysam_bam = FakeAlignmentFile({}, all_lengths=lengths)
+        avg_cov = self._average(mocker, [AlignInfo("chr1", 100000, 20, 0)], pysam_bam)
+        assert pysam_bam.fetched
+        assert avg_cov == 20 * np.median(lengths) / 1000.0
+
+    def test_even_read_count_median(self, mocker):
+        lengths = [50, 100, 150, 300]
+        pysam_bam = FakeAlignmentFile({"chr1": lengths})
+        avg_cov = self._average(mocker, [AlignInfo("chr1", 100000, 10, 0)], pysam_bam)
+        assert avg_cov == 10 * np.median(lengths * 20) / 1000.0 == 1.25